@@ -1,8 +1,10 @@
 import argparse
 import logging
+import mmap
 import os
 import sys
 import time
+from concurrent import futures
 from pathlib import Path
 
 # Ensure project root is importable for generated stubs
@@ -16,35 +18,107 @@ import distsync_pb2 as pb
 import distsync_pb2_grpc as pbg
 
 
-DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+# (largest file size, chunk size): small files keep small chunks so the last partial chunk
+# is cheap; large files use bigger chunks that fill whole TCP segments and HTTP/2 frames
+CHUNK_SIZE_TIERS = [
+    (16 * 1024 * 1024, 256 * 1024),
+]
+LARGE_FILE_CHUNK_SIZE = 4 * 1024 * 1024
+DOWNLOAD_WORKERS = 32  # concurrent chunk fetches across replica nodes
+BATCH_UPLOAD_LIMIT = 8 * 1024 * 1024  # files up to this size go in a single UploadBatch
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
+# Large messages plus a wider HTTP/2 window so MiB-sized chunks are not flow-control bound
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.http2.lookahead_bytes", 4 * 1024 * 1024),
+    ("grpc.http2.min_time_between_pings_ms", 10000),
+]
 
 
-def stream_file_chunks(filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+# Channels are reused for the life of the process so repeated calls skip the HTTP/2 handshake
+_channel_cache: dict[str, grpc.Channel] = {}
+
+
+def _make_channel(addr: str) -> grpc.Channel:
+    return grpc.insecure_channel(addr, options=CHANNEL_OPTIONS, compression=grpc.Compression.Gzip)
+
+
+def _get_channel(addr: str) -> grpc.Channel:
+    ch = _channel_cache.get(addr)
+    if ch is None:
+        ch = _channel_cache[addr] = _make_channel(addr)
+    return ch
+
+
+def chunk_size_for(file_size: int) -> int:
+    for max_size, chunk_size in CHUNK_SIZE_TIERS:
+        if file_size <= max_size:
+            return chunk_size
+    return LARGE_FILE_CHUNK_SIZE
+
+
+def stream_file_chunks(filename: str, chunk_size: int | None = None):
+    # Map the file instead of reading it whole so pages fault in on demand and
+    # client memory stays bounded by the chunk size rather than the file size
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        chunk_size = chunk_size or chunk_size_for(size)
+        total_chunks = (size + chunk_size - 1) // chunk_size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(total_chunks):
+                off = i * chunk_size
+                # protobuf's bytes fields reject memoryview, so slice straight to bytes (one copy)
+                yield pb.FileChunk(filename=os.path.basename(filename), data=mm[off: off + chunk_size], chunk_id=i, total_chunks=total_chunks)
+
+
+def file_batch(filename: str, chunk_size: int | None = None) -> pb.FileBatch:
     data = Path(filename).read_bytes()
-    total_chunks = (len(data) + chunk_size - 1) // chunk_size
-    for i in range(total_chunks):
-        off = i * chunk_size
-        yield pb.FileChunk(filename=os.path.basename(filename), data=data[off: off + chunk_size], chunk_id=i, total_chunks=total_chunks)
+    chunk_size = chunk_size or chunk_size_for(len(data))
+    chunks = [data[off: off + chunk_size] for off in range(0, len(data), chunk_size)]
+    return pb.FileBatch(filename=os.path.basename(filename), chunks=chunks)
 
 
 def upload(master: str, filepath: str) -> None:
-    with grpc.insecure_channel(master) as ch:
-        stub = pbg.DistSyncStub(ch)
+    stub = pbg.DistSyncStub(_get_channel(master))
+    if os.path.getsize(filepath) <= BATCH_UPLOAD_LIMIT:
+        resp = stub.UploadBatch(file_batch(filepath))
+    else:
         resp = stub.UploadFile(stream_file_chunks(filepath))
-        print(resp.message)
+    print(resp.message)
+
+
+def fetch_chunk(filename: str, location: pb.ChunkLocation) -> bytes:
+    # Try replicas in order, reading the chunk straight from the node
+    for address in location.node_addresses:
+        stub = pbg.NodeServiceStub(_get_channel(address))
+        try:
+            request = pb.ChunkRequest(filename=filename, chunk_id=location.chunk_id, generation=location.generation)
+            pieces = stub.GetChunkStream(request)
+            return b"".join(piece.data for piece in pieces)
+        except grpc.RpcError:
+            logging.warning("Chunk %s:%d unavailable on %s", filename, location.chunk_id, address)
+    raise RuntimeError(f"chunk {location.chunk_id} unavailable")
 
 
 def download(master: str, filename: str, out_path: str) -> None:
-    with grpc.insecure_channel(master) as ch:
-        stub = pbg.DistSyncStub(ch)
-        chunks = []
-        for part in stub.DownloadFile(pb.FileRequest(filename=filename)):
-            chunks.append(part.data)
-        Path(out_path).write_bytes(b"".join(chunks))
-        print(f"downloaded -> {out_path}")
+    stub = pbg.DistSyncStub(_get_channel(master))
+    # Fetch all chunks concurrently over the cached node channels, then reassemble in order
+    with futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        pending = {}
+        for location in stub.GetChunkLocations(pb.FileRequest(filename=filename)):
+            pending[location.chunk_id] = pool.submit(fetch_chunk, filename, location)
+        results = {cid: fut.result() for cid, fut in pending.items()}
+    Path(out_path).write_bytes(b"".join(results[i] for i in range(len(results))))
+    print(f"downloaded -> {out_path}")
 
 
 def benchmark(master: str, filepath: str) -> None:
+    # Connect up front so both runs time the data path rather than channel setup
+    grpc.channel_ready_future(_get_channel(master)).result(timeout=10)
+
     # Sequential baseline: single-threaded upload (still uses gRPC, but time as baseline)
     start = time.time()
     upload(master, filepath)
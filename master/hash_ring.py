@@ -1,53 +1,131 @@
 import hashlib
-from bisect import bisect_right
+from functools import lru_cache
 from typing import Dict, List, Tuple
 
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:  # pragma: no cover - fall back to truncated SHA-256
+    xxhash = None
+
+
+GOLDEN_RATIO_64 = 0x9E3779B97F4A7C15
+MASK_64 = (1 << 64) - 1
+
+
+@lru_cache(maxsize=65536)
+def hash_key(key: str) -> int:
+    # Ring placement needs uniformity, not collision resistance; 64 bits fit the uint64 ring
+    data = key.encode("utf-8")
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(data)
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], "big")
+
+
+def chunk_hash(filename_hash: int, chunk_id: int) -> int:
+    # Spread consecutive chunk ids around the ring without hashing a per-chunk string
+    return filename_hash ^ ((chunk_id * GOLDEN_RATIO_64) & MASK_64)
+
 
 class ConsistentHashRing:
     def __init__(self, replication_factor: int = 100) -> None:
         self._replication_factor = replication_factor
-        self._ring: List[Tuple[int, str]] = []
-        self._nodes: Dict[str, List[int]] = {}
+        # Sorted vnode positions; _ring_owners[i] indexes _node_list for the owner of _ring_hashes[i]
+        self._ring_hashes: np.ndarray = np.empty(0, dtype=np.uint64)
+        self._ring_owners: np.ndarray = np.empty(0, dtype=np.int32)
+        # Plain-int copy of _ring_owners for the scalar walks in the lookup fast paths
+        self._owner_seq: List[int] = []
+        self._node_list: List[str] = []
+        self._owner_ids: Dict[str, int] = {}
+        self._nodes: Dict[str, np.ndarray] = {}
 
-    @staticmethod
-    def _hash_key(key: str) -> int:
-        return int(hashlib.sha256(key.encode("utf-8")).hexdigest(), 16)
+    _hash_key = staticmethod(hash_key)
 
     def add_node(self, node_id: str) -> None:
         if node_id in self._nodes:
             return
-        points: List[int] = []
-        for i in range(self._replication_factor):
-            h = self._hash_key(f"{node_id}:{i}")
-            points.append(h)
-            self._ring.append((h, node_id))
-        self._ring.sort(key=lambda x: x[0])
+        owner = self._owner_ids.get(node_id)
+        if owner is None:
+            owner = len(self._node_list)
+            self._owner_ids[node_id] = owner
+            self._node_list.append(node_id)
+        points = np.fromiter(
+            (self._hash_key(f"{node_id}:{i}") for i in range(self._replication_factor)),
+            dtype=np.uint64,
+            count=self._replication_factor,
+        )
+        hashes = np.concatenate([self._ring_hashes, points])
+        owners = np.concatenate([self._ring_owners, np.full(len(points), owner, dtype=np.int32)])
+        order = np.argsort(hashes, kind="stable")
+        self._ring_hashes = hashes[order]
+        self._ring_owners = owners[order]
+        self._owner_seq = self._ring_owners.tolist()
         self._nodes[node_id] = points
 
     def remove_node(self, node_id: str) -> None:
         points = self._nodes.pop(node_id, None)
         if points is None:
             return
-        point_set = set(points)
-        self._ring = [(h, n) for (h, n) in self._ring if not (n == node_id and h in point_set)]
+        keep = self._ring_owners != self._owner_ids[node_id]
+        self._ring_hashes = self._ring_hashes[keep]
+        self._ring_owners = self._ring_owners[keep]
+        self._owner_seq = self._ring_owners.tolist()
 
     def get_nodes_for_key(self, key: str, count: int = 1) -> List[str]:
-        if not self._ring:
+        return self.get_nodes_for_hash(self._hash_key(key), count=count)
+
+    def get_nodes_for_hash(self, key_hash: int, count: int = 1) -> List[str]:
+        n = len(self._ring_hashes)
+        if n == 0:
+            return []
+        idx = int(np.searchsorted(self._ring_hashes, np.uint64(key_hash), side="right"))
+        want = min(count, len(self._nodes))
+        if want <= 0:
             return []
-        key_hash = self._hash_key(key)
-        idx = bisect_right(self._ring, (key_hash, ""))
-        selected: List[str] = []
-        seen = set()
-        i = idx
-        while len(selected) < min(count, len(self._nodes)):
-            pos = i % len(self._ring)
-            node_id = self._ring[pos][1]
-            if node_id not in seen:
-                seen.add(node_id)
-                selected.append(node_id)
+        if want == 1:
+            selected = self._get_1(idx)
+        elif want == 2:
+            selected = self._get_2(idx)
+        elif want == 3:
+            selected = self._get_3(idx)
+        else:
+            # First occurrence of each owner walking clockwise from idx
+            window = np.roll(self._ring_owners, -(idx % n))
+            owners, first = np.unique(window, return_index=True)
+            selected = owners[np.argsort(first, kind="stable")][:want].tolist()
+        return [self._node_list[o] for o in selected]
+
+    # Unrolled walks for the usual replica counts; callers guarantee enough distinct owners
+    def _get_1(self, idx: int) -> Tuple[int, ...]:
+        owners = self._owner_seq
+        return (owners[idx % len(owners)],)
+
+    def _get_2(self, idx: int) -> Tuple[int, ...]:
+        owners = self._owner_seq
+        n = len(owners)
+        first = owners[idx % n]
+        i = idx + 1
+        while True:
+            o = owners[i % n]
+            if o != first:
+                return (first, o)
+            i += 1
+
+    def _get_3(self, idx: int) -> Tuple[int, ...]:
+        owners = self._owner_seq
+        n = len(owners)
+        first = owners[idx % n]
+        second = -1
+        i = idx + 1
+        while True:
+            o = owners[i % n]
+            if o != first:
+                if second < 0:
+                    second = o
+                elif o != second:
+                    return (first, second, o)
             i += 1
-        return selected
 
     def nodes(self) -> List[str]:
         return list(self._nodes.keys())
-
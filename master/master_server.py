@@ -1,13 +1,13 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
 import sys
 import threading
 import time
-from concurrent import futures
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, FrozenSet, List, Set, Tuple
 
 # Ensure project root is importable for generated stubs
 ROOT = Path(__file__).resolve().parents[1]
@@ -18,10 +18,33 @@ import grpc
 
 import distsync_pb2 as pb
 import distsync_pb2_grpc as pbg
-from master.hash_ring import ConsistentHashRing
+from master.hash_ring import ConsistentHashRing, chunk_hash, hash_key
 
 
 DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
+NODE_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 20000),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+# Large messages plus a wider HTTP/2 window so MiB-sized chunks are not flow-control bound
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.http2.lookahead_bytes", 4 * 1024 * 1024),
+    ("grpc.http2.min_time_between_pings_ms", 10000),
+]
+SERVER_OPTIONS = [
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+    # Accept the nodes' idle heartbeat-channel keepalive pings
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+]
+UPLOAD_QUEUE_DEPTH = 4  # chunks buffered per node stream during an upload
+METADATA_FLUSH_DELAY = 0.5  # seconds to coalesce metadata mutations before writing
+HEARTBEAT_TIMEOUT = 10.0  # seconds without a heartbeat before a node is considered dead
+LIVENESS_SWEEP_INTERVAL = 1.0
 
 
 class Coordinator(pbg.DistSyncServicer):
@@ -32,8 +55,16 @@ class Coordinator(pbg.DistSyncServicer):
         self._ring = ConsistentHashRing(replication_factor=128)
         self._node_address: Dict[str, str] = {}
         self._node_last_heartbeat: Dict[str, float] = {}
+        # Replaced, never mutated, so readers can hold a snapshot without copying
+        self._live_set: FrozenSet[str] = frozenset()
+        self._node_channels: Dict[str, grpc.aio.Channel] = {}
+        self._node_async_stubs: Dict[str, pbg.NodeServiceStub] = {}
         self._file_index: Dict[str, Dict[str, int]] = {}
+        self._metadata_dirty = threading.Event()
+        self._metadata_write_lock = threading.Lock()
         self._load_metadata()
+        threading.Thread(target=self._flush_metadata_loop, daemon=True).start()
+        threading.Thread(target=self._expire_nodes_loop, daemon=True).start()
 
     # Metadata persistence
     def _load_metadata(self) -> None:
@@ -50,135 +81,265 @@ class Coordinator(pbg.DistSyncServicer):
         for node_id, address in nodes.items():
             self._node_address[node_id] = address
             self._ring.add_node(node_id)
-            self._node_last_heartbeat[node_id] = time.time()
+            self._mark_alive(node_id)
 
     def _save_metadata(self) -> None:
-        data = {
-            "nodes": self._node_address,
-            "files": self._file_index,
-        }
-        self._metadata_path.write_text(json.dumps(data, indent=2))
+        # Must not be called with self._lock held. Only the shallow copies happen under it;
+        # file index values are replaced, never mutated, so serializing the copies is safe.
+        with self._metadata_write_lock:
+            with self._lock:
+                self._metadata_dirty.clear()
+                nodes = dict(self._node_address)
+                files = dict(self._file_index)
+            payload = json.dumps({"nodes": nodes, "files": files})
+            tmp_path = self._metadata_path.with_name(self._metadata_path.name + ".tmp")
+            tmp_path.write_text(payload)
+            os.replace(tmp_path, self._metadata_path)
+
+    def _flush_metadata_loop(self) -> None:
+        # Coalesce bursts of mutations into a single write
+        while True:
+            self._metadata_dirty.wait()
+            time.sleep(METADATA_FLUSH_DELAY)
+            try:
+                self._save_metadata()
+            except Exception:
+                logging.exception("Failed to write metadata")
+
+    def flush_metadata(self) -> None:
+        if self._metadata_dirty.is_set():
+            self._save_metadata()
 
     # DistSync RPCs
-    def RegisterNode(self, request: pb.NodeInfo, context) -> pb.Ack:
+    async def RegisterNode(self, request: pb.NodeInfo, context) -> pb.Ack:
+        stale: grpc.aio.Channel | None = None
         with self._lock:
+            if self._node_address.get(request.node_id) != request.address:
+                stale = self._node_channels.pop(request.node_id, None)
+                self._node_async_stubs.pop(request.node_id, None)
             self._node_address[request.node_id] = request.address
-            self._node_last_heartbeat[request.node_id] = time.time()
+            self._mark_alive(request.node_id)
+            self._node_stub(request.node_id)
             if request.node_id not in self._ring.nodes():
                 self._ring.add_node(request.node_id)
-            self._save_metadata()
+            self._metadata_dirty.set()
+        if stale is not None:
+            await stale.close()
         logging.info("Node registered: %s @ %s", request.node_id, request.address)
         return pb.Ack(success=True, message="registered")
 
-    def Heartbeat(self, request: pb.NodeHeartbeat, context) -> pb.Ack:
+    async def Heartbeat(self, request: pb.NodeHeartbeat, context) -> pb.Ack:
         with self._lock:
             if request.node_id in self._node_address:
-                self._node_last_heartbeat[request.node_id] = time.time()
+                self._mark_alive(request.node_id)
                 return pb.Ack(success=True, message="ok")
         return pb.Ack(success=False, message="unknown node")
 
-    def UploadFile(self, request_iterator, context) -> pb.UploadStatus:
-        # Buffer incoming stream into chunks
-        first: pb.FileChunk | None = None
-        chunks: List[pb.FileChunk] = []
-        for part in request_iterator:
-            if first is None:
-                first = part
-            chunks.append(part)
-        if first is None:
-            return pb.UploadStatus(message="no data")
+    async def UploadFile(self, request_iterator, context) -> pb.UploadStatus:
+        return await self._store_chunks(request_iterator)
+
+    async def UploadBatch(self, request: pb.FileBatch, context) -> pb.UploadStatus:
+        async def batch_chunks():
+            total_chunks = len(request.chunks)
+            for cid, data in enumerate(request.chunks):
+                yield pb.FileChunk(filename=request.filename, data=data, chunk_id=cid, total_chunks=total_chunks)
 
-        filename = first.filename
-        total_chunks = first.total_chunks or len(chunks)
+        return await self._store_chunks(batch_chunks())
 
-        # Determine placement via consistent hashing with replication
+    async def _store_chunks(self, chunk_iterator) -> pb.UploadStatus:
         with self._lock:
             live_nodes = self._live_nodes()
-            if not live_nodes:
-                return pb.UploadStatus(message="no live nodes")
-            chunk_map: Dict[str, int] = {}
-            placements: Dict[int, List[str]] = {}
-            for chunk in chunks:
-                key = f"{filename}:{chunk.chunk_id}"
-                node_ids = self._ring.get_nodes_for_key(key, count=self._replication)
-                # filter to live
-                node_ids = [n for n in node_ids if n in live_nodes]
+
+        # Forward each chunk to its replica streams as it arrives instead of buffering the file
+        queues: Dict[str, asyncio.Queue] = {}
+        senders: List[asyncio.Task] = []
+        replicas: Set[str] = set()
+        filename: str | None = None
+        total_chunks = 0
+        received = 0
+        status = "ok"
+        # Nodes stage this upload as a new generation next to the committed copy
+        generation = time.time_ns()
+        try:
+            async for chunk in chunk_iterator:
+                if filename is None:
+                    if not live_nodes:
+                        status = "no live nodes"
+                        break
+                    filename = chunk.filename
+                    filename_hash = hash_key(filename)
+                    total_chunks = chunk.total_chunks
+                received += 1
+
+                # Determine placement via consistent hashing with replication
+                key_hash = chunk_hash(filename_hash, chunk.chunk_id)
+                with self._lock:
+                    node_ids = self._ring.get_nodes_for_hash(key_hash, count=self._replication)
+                    # filter to live
+                    node_ids = [n for n in node_ids if n in live_nodes]
+                    chain = [self._node_address[n] for n in node_ids[1:]]
                 if not node_ids:
-                    return pb.UploadStatus(message="no live nodes for chunk")
-                placements[chunk.chunk_id] = node_ids
-                for nid in node_ids:
-                    chunk_map_key = f"{nid}:{chunk.chunk_id}"
-                    chunk_map[chunk_map_key] = 1
-
-        # Fanout to nodes concurrently
-        def store_to_node(node_id: str, chunk: pb.FileChunk) -> Tuple[str, int]:
-            address = self._node_address[node_id]
-            with grpc.insecure_channel(address) as ch:
-                stub = pbg.NodeServiceStub(ch)
-                stub.StoreChunk(chunk)
-            return (node_id, chunk.chunk_id)
-
-        with futures.ThreadPoolExecutor(max_workers=16) as pool:
-            futs = []
-            for chunk in chunks:
-                node_ids = placements[chunk.chunk_id]
-                for nid in node_ids:
-                    futs.append(pool.submit(store_to_node, nid, chunk))
-            for f in futures.as_completed(futs):
-                try:
-                    f.result()
-                except Exception as e:
-                    logging.exception("StoreChunk failed: %s", e)
+                    status = "no live nodes for chunk"
+                    break
+                replicas.update(node_ids)
+                # Chain replication: only the first replica receives the chunk from us and
+                # forwards it along the rest of the chain
+                del chunk.replica_chain[:]
+                chunk.replica_chain.extend(chain)
+                chunk.generation = generation
+                head = node_ids[0]
+                q = queues.get(head)
+                if q is None:
+                    q = queues[head] = asyncio.Queue(maxsize=UPLOAD_QUEUE_DEPTH)
+                    senders.append(asyncio.create_task(self._stream_to_node(head, q)))
+                await q.put(chunk)
+        finally:
+            for q in queues.values():
+                await q.put(None)
+            stored = await asyncio.gather(*senders)
+
+        if status != "ok":
+            return pb.UploadStatus(message=status)
+        if filename is None:
+            return pb.UploadStatus(message="no data")
+        failed = [nid for nid, ok in zip(queues, stored) if not ok]
+        if failed:
+            # A broken chain head (or a hop behind it) means some chunks have no replica at all
+            return pb.UploadStatus(message=f"replication failed via {', '.join(failed)}")
+
+        # Nodes ack chunks once queued for disk; make the file durable before indexing it
+        synced = await asyncio.gather(*(self._sync_node(nid, filename) for nid in replicas))
+        unsynced = [nid for nid, ok in zip(replicas, synced) if not ok]
+        if unsynced:
+            return pb.UploadStatus(message=f"sync failed on {', '.join(unsynced)}")
 
         with self._lock:
-            # track minimal file index (store total_chunks under filename)
-            self._file_index[filename] = {"total_chunks": total_chunks}
-            self._save_metadata()
+            indexed = self._file_index.get(filename)
+            if indexed and indexed.get("generation", 0) > generation:
+                return pb.UploadStatus(message="superseded by a newer upload")
+            # track minimal file index (total_chunks and the generation to read)
+            self._file_index[filename] = {"total_chunks": total_chunks or received, "generation": generation}
+            self._metadata_dirty.set()
 
+        # Only now may replicas drop the previous generation; readers already ask for this one,
+        # so a node that misses the commit just keeps the old files a while longer
+        await asyncio.gather(*(self._commit_node(nid, filename, generation) for nid in replicas))
         return pb.UploadStatus(message="ok")
 
-    def DownloadFile(self, request: pb.FileRequest, context):
+    async def GetChunkLocations(self, request: pb.FileRequest, context):
+        # Metadata only: clients fetch chunk data directly from the listed nodes
         filename = request.filename
         with self._lock:
             info = self._file_index.get(filename)
-            if not info:
-                context.abort(grpc.StatusCode.NOT_FOUND, "file not found")
-            total_chunks = int(info.get("total_chunks", 0))
             live_nodes = self._live_nodes()
-            if not live_nodes:
-                context.abort(grpc.StatusCode.FAILED_PRECONDITION, "no live nodes")
+        if not info:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "file not found")
+        total_chunks = int(info.get("total_chunks", 0))
+        generation = int(info.get("generation", 0))
+        if not live_nodes:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, "no live nodes")
 
-        # For each chunk, pick first available replica by ring order
+        # Replicas are listed in ring order so clients try the primary first
+        filename_hash = hash_key(filename)
         for cid in range(total_chunks):
-            key = f"{filename}:{cid}"
-            node_ids = self._ring.get_nodes_for_key(key, count=self._replication)
-            sent = False
-            for nid in node_ids:
-                with self._lock:
-                    if nid not in live_nodes:
-                        continue
-                    address = self._node_address[nid]
-                try:
-                    with grpc.insecure_channel(address) as ch:
-                        stub = pbg.NodeServiceStub(ch)
-                        chunk = stub.GetChunk(pb.ChunkRequest(filename=filename, chunk_id=cid))
-                        yield chunk
-                        sent = True
-                        break
-                except Exception:
-                    logging.warning("Chunk %s:%d unavailable on %s", filename, cid, nid)
-                    continue
-            if not sent:
-                context.abort(grpc.StatusCode.UNAVAILABLE, f"chunk {cid} unavailable")
+            key_hash = chunk_hash(filename_hash, cid)
+            with self._lock:
+                node_ids = self._ring.get_nodes_for_hash(key_hash, count=self._replication)
+                addresses = [self._node_address[n] for n in node_ids if n in live_nodes]
+            if not addresses:
+                await context.abort(grpc.StatusCode.UNAVAILABLE, f"chunk {cid} unavailable")
+            yield pb.ChunkLocation(chunk_id=cid, node_addresses=addresses, generation=generation)
 
     # Utilities
-    def _live_nodes(self) -> List[str]:
-        now = time.time()
-        live: List[str] = []
-        for nid, ts in self._node_last_heartbeat.items():
-            if now - ts <= 10.0:  # 10s heartbeat window
-                live.append(nid)
-        return live
+    def _node_stub(self, node_id: str) -> pbg.NodeServiceStub:
+        # Caller holds self._lock and runs on the event loop. Channels are persistent and
+        # reused across requests; they are opened lazily so nodes loaded from metadata work too.
+        stub = self._node_async_stubs.get(node_id)
+        if stub is None:
+            ch = _make_channel(self._node_address[node_id])
+            self._node_channels[node_id] = ch
+            stub = self._node_async_stubs[node_id] = pbg.NodeServiceStub(ch)
+        return stub
+
+    async def _stream_to_node(self, node_id: str, chunks: asyncio.Queue) -> bool:
+        # Feeds one StoreChunkStream from the upload pipeline until the None sentinel arrives
+        done = False
+
+        async def drain():
+            nonlocal done
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    done = True
+                    return
+                yield chunk
+
+        try:
+            with self._lock:
+                stub = self._node_stub(node_id)
+            ack = await stub.StoreChunkStream(drain())
+            if not ack.success:
+                logging.warning("StoreChunkStream to %s: %s", node_id, ack.message)
+            return ack.success
+        except Exception as e:
+            logging.exception("StoreChunkStream to %s failed: %s", node_id, e)
+            # keep consuming so the ingest loop never blocks on a dead stream
+            if not done:
+                async for _ in drain():
+                    pass
+            return False
+
+    def _mark_alive(self, node_id: str) -> None:
+        # Caller holds self._lock
+        self._node_last_heartbeat[node_id] = time.time()
+        if node_id not in self._live_set:
+            self._live_set = self._live_set | {node_id}
+
+    def _expire_nodes_loop(self) -> None:
+        # Janitor: drop nodes whose last heartbeat is outside the window
+        while True:
+            time.sleep(LIVENESS_SWEEP_INTERVAL)
+            now = time.time()
+            with self._lock:
+                expired = {nid for nid in self._live_set if now - self._node_last_heartbeat[nid] > HEARTBEAT_TIMEOUT}
+                if expired:
+                    self._live_set = self._live_set - expired
+                    logging.info("Nodes expired: %s", ", ".join(sorted(expired)))
+
+    async def _sync_node(self, node_id: str, filename: str) -> bool:
+        try:
+            with self._lock:
+                stub = self._node_stub(node_id)
+            ack = await stub.Sync(pb.FileRequest(filename=filename))
+            if not ack.success:
+                logging.warning("Sync on %s: %s", node_id, ack.message)
+            return ack.success
+        except Exception as e:
+            logging.warning("Sync on %s failed: %s", node_id, e)
+            return False
+
+    async def _commit_node(self, node_id: str, filename: str, generation: int) -> bool:
+        try:
+            with self._lock:
+                stub = self._node_stub(node_id)
+            ack = await stub.Commit(pb.FileRequest(filename=filename, generation=generation))
+            if not ack.success:
+                logging.warning("Commit on %s: %s", node_id, ack.message)
+            return ack.success
+        except Exception as e:
+            logging.warning("Commit on %s failed: %s", node_id, e)
+            return False
+
+    def _live_nodes(self) -> FrozenSet[str]:
+        return self._live_set
+
+
+def _make_channel(addr: str) -> grpc.aio.Channel:
+    return grpc.aio.insecure_channel(
+        addr,
+        options=NODE_CHANNEL_OPTIONS + CHANNEL_OPTIONS,
+        compression=grpc.Compression.Gzip,
+    )
 
 
 def chunk_bytes(filename: str, data: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[Tuple[int, bytes]]:
@@ -190,21 +351,22 @@ def chunk_bytes(filename: str, data: bytes, chunk_size: int = DEFAULT_CHUNK_SIZE
     return chunks
 
 
-def serve(bind: str, replication: int) -> None:
+async def serve(bind: str, replication: int) -> None:
     logging.basicConfig(level=logging.INFO, format="[master] %(asctime)s %(levelname)s %(message)s")
     meta_path = ROOT / "master" / "metadata.json"
     if not meta_path.exists():
-        meta_path.write_text(json.dumps({"nodes": {}, "files": {}}, indent=2))
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
-    pbg.add_DistSyncServicer_to_server(Coordinator(replication=replication, metadata_path=meta_path), server)
+        meta_path.write_text(json.dumps({"nodes": {}, "files": {}}))
+    server = grpc.aio.server(options=SERVER_OPTIONS)
+    coordinator = Coordinator(replication=replication, metadata_path=meta_path)
+    pbg.add_DistSyncServicer_to_server(coordinator, server)
     server.add_insecure_port(bind)
-    server.start()
+    await server.start()
     logging.info("Master listening on %s (replicas=%d)", bind, replication)
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        server.stop(0)
+        await server.wait_for_termination()
+    finally:
+        await server.stop(0)
+        coordinator.flush_metadata()
 
 
 def main() -> None:
@@ -212,7 +374,10 @@ def main() -> None:
     parser.add_argument("--bind", default="0.0.0.0:50050")
     parser.add_argument("--replicas", type=int, default=2)
     args = parser.parse_args()
-    serve(args.bind, args.replicas)
+    try:
+        asyncio.run(serve(args.bind, args.replicas))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -1,11 +1,17 @@
 import argparse
+import asyncio
+import functools
+import glob
 import logging
 import os
+import struct
 import sys
 import threading
 import time
+from collections import defaultdict
 from concurrent import futures
 from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
 
 # Ensure project root is importable for generated stubs
 ROOT = Path(__file__).resolve().parents[1]
@@ -18,49 +24,379 @@ import distsync_pb2 as pb
 import distsync_pb2_grpc as pbg
 
 
+STREAM_PIECE_SIZE = 64 * 1024  # bytes per GetChunkStream message
+MAX_MESSAGE_LENGTH = 16 * 1024 * 1024
+SERVER_OPTIONS = [
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+    # Accept the coordinator's and peers' idle keepalive pings instead of answering
+    # them with GOAWAY "too_many_pings"
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.min_ping_interval_without_data_ms", 10000),
+]
+HEARTBEAT_CHANNEL_OPTIONS = [("grpc.keepalive_time_ms", 10000)]
+PEER_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 20000),
+    ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+    ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+]
+FORWARD_QUEUE_DEPTH = 4  # chunks buffered per downstream replica stream
+WRITER_THREADS = 4
+WRITE_QUEUE_DEPTH = 64  # chunks accepted but not yet on disk before stores block
+MAX_CONCURRENT_RPCS = 256
+# One .idx slot per chunk id: blob offset, length, flags
+INDEX_ENTRY = struct.Struct("<QII")
+INDEX_PRESENT = 1
+
+
 class NodeServicer(pbg.NodeServiceServicer):
     def __init__(self, storage_dir: Path) -> None:
         self._storage_dir = storage_dir
-        self._lock = threading.Lock()
         self._storage_dir.mkdir(parents=True, exist_ok=True)
+        # Serializes appends to a file's blob and updates to its index
+        self._file_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._generations: Dict[str, Optional[int]] = {}
+        self._peer_stubs: Dict[str, pbg.NodeServiceStub] = {}
+        # Background writers: stores are acked once submitted, reads are served from
+        # _pending until the chunk is on disk, and Sync makes a file durable. Writer
+        # threads only touch disk; the bookkeeping below is owned by the event loop.
+        self._writer_pool = futures.ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="chunk-writer")
+        self._write_slots = asyncio.Semaphore(WRITE_QUEUE_DEPTH)
+        self._inflight: Dict[str, Set[asyncio.Future]] = {}
+        self._pending: Dict[Tuple[str, int, int], bytes] = {}
+        self._unsynced: Dict[str, Set[Path]] = {}
+        self._failed_writes: Dict[str, int] = {}
+
+    # Packed storage: all chunks of one upload generation of a file are appended to
+    # <name>.<generation>.blob, and a fixed-width .idx maps chunk_id -> (offset, length)
+    # so a read is one index lookup plus one pread. A new generation is staged next to
+    # the committed one and replaces it on Commit, so re-uploads don't grow storage and
+    # a failed re-upload leaves the previous copy readable.
+    @staticmethod
+    def _safe_name(filename: str) -> str:
+        return filename.replace("/", "_")
+
+    def _blob_path(self, safe: str, generation: int) -> Path:
+        return self._storage_dir / f"{safe}.{generation}.blob"
+
+    def _idx_path(self, safe: str, generation: int) -> Path:
+        return self._storage_dir / f"{safe}.{generation}.idx"
+
+    def _generation_path(self, safe: str) -> Path:
+        # Holds the committed generation
+        return self._storage_dir / f"{safe}.gen"
+
+    def _committed_generation(self, safe: str) -> Optional[int]:
+        # Callers hold the file's lock; read from disk once, then kept up to date by commits
+        if safe not in self._generations:
+            try:
+                self._generations[safe] = int(self._generation_path(safe).read_text())
+            except FileNotFoundError:
+                self._generations[safe] = None
+        return self._generations[safe]
+
+    def _write_chunk(
+        self, filename: str, chunk_id: int, data: bytes, generation: int = 0
+    ) -> Optional[Tuple[Path, Path]]:
+        # Returns the paths written, or None if the write was dropped as superseded
+        safe = self._safe_name(filename)
+        with self._file_locks[safe]:
+            committed = self._committed_generation(safe)
+            if committed is not None and generation < committed:
+                return None
+            blob_path = self._blob_path(safe, generation)
+            idx_path = self._idx_path(safe, generation)
+            # Data lands before its index entry, so readers never see an entry without data
+            with open(blob_path, "ab") as f:
+                offset = os.fstat(f.fileno()).st_size
+                f.write(data)
+            fd = os.open(idx_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, INDEX_ENTRY.pack(offset, len(data), INDEX_PRESENT), chunk_id * INDEX_ENTRY.size)
+            finally:
+                os.close(fd)
+        return blob_path, idx_path
+
+    def _commit_generation(self, filename: str, generation: int) -> bool:
+        safe = self._safe_name(filename)
+        with self._file_locks[safe]:
+            committed = self._committed_generation(safe)
+            if committed is not None and generation < committed:
+                return False
+            path = self._generation_path(safe)
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_text(str(generation))
+            os.replace(tmp_path, path)
+            self._generations[safe] = generation
+            # Older generations (the previous copy, or abandoned uploads) are no longer read
+            for p in self._storage_dir.glob(f"{glob.escape(safe)}.*"):
+                stem, _, suffix = p.name.rpartition(".")
+                name, _, gen = stem.rpartition(".")
+                if suffix in ("blob", "idx") and name == safe and gen.isdigit() and int(gen) < generation:
+                    p.unlink(missing_ok=True)
+        return True
+
+    def _read_index(self, filename: str, chunk_id: int, generation: int = 0) -> Optional[Tuple[Path, int, int]]:
+        # Returns (path, offset, length) of the chunk's bytes; generation 0 reads the committed copy
+        if chunk_id < 0:
+            return None
+        safe = self._safe_name(filename)
+        with self._file_locks[safe]:
+            if generation == 0:
+                generation = self._committed_generation(safe) or 0
+            try:
+                fd = os.open(self._idx_path(safe, generation), os.O_RDONLY)
+            except FileNotFoundError:
+                return None
+            try:
+                raw = os.pread(fd, INDEX_ENTRY.size, chunk_id * INDEX_ENTRY.size)
+            finally:
+                os.close(fd)
+        if len(raw) < INDEX_ENTRY.size:
+            return None
+        offset, length, flags = INDEX_ENTRY.unpack(raw)
+        if not flags & INDEX_PRESENT:
+            return None
+        return self._blob_path(safe, generation), offset, length
+
+    def _read_chunk(self, filename: str, chunk_id: int, generation: int = 0) -> Optional[bytes]:
+        location = self._read_index(filename, chunk_id, generation)
+        if location is None:
+            return None
+        path, offset, length = location
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            # dropped by a commit since the index lookup
+            return None
+        try:
+            return os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+
+    def _fsync_paths(self, paths: Set[Path]) -> None:
+        for p in paths:
+            try:
+                fd = os.open(p, os.O_RDONLY)
+            except FileNotFoundError:
+                # dropped by a commit of a newer generation
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if paths:
+            fd = os.open(self._storage_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    async def _enqueue_write(self, chunk: pb.FileChunk) -> None:
+        # Waits only for a free write slot (bounded by disk speed), never on another RPC
+        key = (chunk.filename, chunk.generation, chunk.chunk_id)
+        data = chunk.data
+        await self._write_slots.acquire()
+        self._pending[key] = data
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(
+            self._writer_pool, self._write_chunk, chunk.filename, chunk.chunk_id, data, chunk.generation
+        )
+        self._inflight.setdefault(chunk.filename, set()).add(fut)
+        fut.add_done_callback(functools.partial(self._write_done, key, data))
 
-    def _chunk_path(self, filename: str, chunk_id: int) -> Path:
-        safe_name = filename.replace("/", "_")
-        return self._storage_dir / f"{safe_name}.{chunk_id}.chunk"
+    def _write_done(self, key: Tuple[str, int, int], data: bytes, fut: asyncio.Future) -> None:
+        # Runs on the event loop once a writer thread finishes
+        filename, _, chunk_id = key
+        inflight = self._inflight.get(filename)
+        if inflight is not None:
+            inflight.discard(fut)
+            if not inflight:
+                del self._inflight[filename]
+        self._write_slots.release()
+        error = None if fut.cancelled() else fut.exception()
+        if fut.cancelled() or error is not None:
+            logging.error("Write of %s:%d failed: %s", filename, chunk_id, error or "cancelled")
+            self._failed_writes[filename] = self._failed_writes.get(filename, 0) + 1
+        else:
+            paths = fut.result()
+            if paths is None:
+                # Fail the superseded upload's Sync so the coordinator doesn't index it
+                logging.warning("Dropped %s:%d from a superseded generation", filename, chunk_id)
+                self._failed_writes[filename] = self._failed_writes.get(filename, 0) + 1
+            else:
+                self._unsynced.setdefault(filename, set()).update(paths)
+        # a newer write of the same chunk may have been submitted meanwhile
+        if self._pending.get(key) is data:
+            del self._pending[key]
 
-    def StoreChunk(self, request: pb.FileChunk, context) -> pb.Ack:
-        p = self._chunk_path(request.filename, request.chunk_id)
-        with self._lock:
-            with open(p, "wb") as f:
-                f.write(request.data)
+    async def StoreChunk(self, request: pb.FileChunk, context) -> pb.Ack:
+        await self._enqueue_write(request)
         return pb.Ack(success=True, message="stored")
 
-    def GetChunk(self, request: pb.ChunkRequest, context) -> pb.FileChunk:
-        p = self._chunk_path(request.filename, request.chunk_id)
-        if not p.exists():
-            context.abort(grpc.StatusCode.NOT_FOUND, "chunk not found")
-        data = p.read_bytes()
+    async def StoreChunkStream(self, request_iterator, context) -> pb.Ack:
+        # Chain replication: store locally, then pass each chunk on to the next hop of its
+        # replica chain over one stream per downstream node for the life of this stream.
+        # Waiting on a downstream hop suspends this coroutine rather than pinning a server
+        # thread, so nodes forwarding to each other cannot starve one another.
+        queues: Dict[str, asyncio.Queue] = {}
+        forwarders: List[asyncio.Task] = []
+        stored = 0
+        try:
+            async for chunk in request_iterator:
+                await self._enqueue_write(chunk)
+                stored += 1
+                if not chunk.replica_chain:
+                    continue
+                next_hop = chunk.replica_chain[0]
+                q = queues.get(next_hop)
+                if q is None:
+                    q = queues[next_hop] = asyncio.Queue(maxsize=FORWARD_QUEUE_DEPTH)
+                    forwarders.append(asyncio.create_task(self._forward_stream(next_hop, q)))
+                await q.put(self._next_hop_chunk(chunk))
+        finally:
+            for q in queues.values():
+                await q.put(None)
+            forwarded = await asyncio.gather(*forwarders)
+        failed = [address for address, ok in zip(queues, forwarded) if not ok]
+        if failed:
+            return pb.Ack(success=False, message=f"stored {stored}; forward failed to {', '.join(failed)}")
+        return pb.Ack(success=True, message=f"stored {stored}")
+
+    async def ForwardChunk(self, request: pb.FileChunk, context) -> pb.Ack:
+        await self._enqueue_write(request)
+        if not request.replica_chain:
+            return pb.Ack(success=True, message="stored")
+        next_hop = request.replica_chain[0]
+        try:
+            return await self._peer_stub(next_hop).StoreChunkStream(iter([self._next_hop_chunk(request)]))
+        except grpc.RpcError as e:
+            logging.warning("Forward of %s:%d to %s failed: %s", request.filename, request.chunk_id, next_hop, e)
+            return pb.Ack(success=False, message=f"stored; forward failed to {next_hop}")
+
+    async def Sync(self, request: pb.FileRequest, context) -> pb.Ack:
+        # Wait only for this file's submitted writes, then flush its chunks to stable storage
+        inflight = self._inflight.get(request.filename)
+        if inflight:
+            await asyncio.wait(list(inflight))
+        paths = self._unsynced.pop(request.filename, set())
+        failed = self._failed_writes.pop(request.filename, 0)
+        await asyncio.to_thread(self._fsync_paths, paths)
+        if failed:
+            return pb.Ack(success=False, message=f"{failed} chunk writes failed")
+        return pb.Ack(success=True, message=f"synced {len(paths)}")
+
+    async def Commit(self, request: pb.FileRequest, context) -> pb.Ack:
+        # Called once the coordinator has indexed the upload: serve it and drop older copies
+        if not await asyncio.to_thread(self._commit_generation, request.filename, request.generation):
+            return pb.Ack(success=False, message="superseded by a newer generation")
+        return pb.Ack(success=True, message="committed")
+
+    async def GetChunk(self, request: pb.ChunkRequest, context) -> pb.FileChunk:
+        data = self._pending.get((request.filename, request.generation, request.chunk_id))
+        if data is None:
+            data = await asyncio.to_thread(self._read_chunk, request.filename, request.chunk_id, request.generation)
+            if data is None:
+                await context.abort(grpc.StatusCode.NOT_FOUND, "chunk not found")
         return pb.FileChunk(filename=request.filename, data=data, chunk_id=request.chunk_id, total_chunks=0)
 
+    async def GetChunkStream(self, request: pb.ChunkRequest, context):
+        pending = self._pending.get((request.filename, request.generation, request.chunk_id))
+        if pending is not None:
+            view = memoryview(pending)
+            for off in range(0, max(len(pending), 1), STREAM_PIECE_SIZE):
+                yield pb.FileChunk(
+                    filename=request.filename,
+                    data=bytes(view[off: off + STREAM_PIECE_SIZE]),
+                    chunk_id=request.chunk_id,
+                    total_chunks=0,
+                )
+            return
+        location = await asyncio.to_thread(self._read_index, request.filename, request.chunk_id, request.generation)
+        if location is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "chunk not found")
+        path, offset, length = location
+        if length == 0:
+            yield pb.FileChunk(filename=request.filename, chunk_id=request.chunk_id, total_chunks=0)
+            return
+        try:
+            fd = await asyncio.to_thread(os.open, path, os.O_RDONLY)
+        except FileNotFoundError:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "chunk replaced")
+        # Stream the chunk in small pieces so RSS stays flat; disk reads run on a worker
+        # thread so a cold blob never stalls the loop (and the forwards waiting on it)
+        try:
+            for off in range(offset, offset + length, STREAM_PIECE_SIZE):
+                data = await asyncio.to_thread(os.pread, fd, min(STREAM_PIECE_SIZE, offset + length - off), off)
+                yield pb.FileChunk(filename=request.filename, data=data, chunk_id=request.chunk_id, total_chunks=0)
+        finally:
+            os.close(fd)
+
+    # Chain replication helpers
+    @staticmethod
+    def _next_hop_chunk(chunk: pb.FileChunk) -> pb.FileChunk:
+        return pb.FileChunk(
+            filename=chunk.filename,
+            data=chunk.data,
+            chunk_id=chunk.chunk_id,
+            total_chunks=chunk.total_chunks,
+            replica_chain=chunk.replica_chain[1:],
+            generation=chunk.generation,
+        )
+
+    def _peer_stub(self, address: str) -> pbg.NodeServiceStub:
+        # Runs on the event loop; aio channels are opened lazily and reused
+        stub = self._peer_stubs.get(address)
+        if stub is None:
+            ch = grpc.aio.insecure_channel(address, options=PEER_CHANNEL_OPTIONS)
+            stub = self._peer_stubs[address] = pbg.NodeServiceStub(ch)
+        return stub
+
+    async def _forward_stream(self, address: str, chunks: asyncio.Queue) -> bool:
+        done = False
+
+        async def drain():
+            nonlocal done
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    done = True
+                    return
+                yield chunk
+
+        try:
+            ack = await self._peer_stub(address).StoreChunkStream(drain())
+            if not ack.success:
+                logging.warning("Downstream %s reported: %s", address, ack.message)
+            return ack.success
+        except Exception as e:
+            logging.warning("Forward stream to %s failed: %s", address, e)
+            # keep consuming so the inbound stream never blocks on a dead hop
+            if not done:
+                async for _ in drain():
+                    pass
+            return False
+
 
 def start_heartbeat(master_addr: str, node_id: str, stop_event: threading.Event) -> None:
+    # One long-lived channel; it is only rebuilt after a failed heartbeat
+    ch = grpc.insecure_channel(master_addr, options=HEARTBEAT_CHANNEL_OPTIONS)
+    stub = pbg.DistSyncStub(ch)
     while not stop_event.is_set():
         try:
-            with grpc.insecure_channel(master_addr) as ch:
-                stub = pbg.DistSyncStub(ch)
-                stub.Heartbeat(pb.NodeHeartbeat(node_id=node_id))
+            stub.Heartbeat(pb.NodeHeartbeat(node_id=node_id), timeout=3.0)
+        except grpc.RpcError:
+            ch.close()
+            ch = grpc.insecure_channel(master_addr, options=HEARTBEAT_CHANNEL_OPTIONS)
+            stub = pbg.DistSyncStub(ch)
         except Exception:
             pass
         stop_event.wait(3.0)
+    ch.close()
 
 
-def serve(node_id: str, bind: str, master_addr: str) -> None:
-    logging.basicConfig(level=logging.INFO, format=f"[node {node_id}] %(asctime)s %(levelname)s %(message)s")
-
-    storage_dir = ROOT / "node" / "storage" / node_id
-    storage_dir.mkdir(parents=True, exist_ok=True)
-
-    # Register with master (retry to handle master startup races)
+def register_with_master(master_addr: str, node_id: str, bind: str) -> None:
+    # Retry to handle master startup races
     register_deadline = time.time() + 30.0
     last_error: Exception | None = None
     while time.time() < register_deadline:
@@ -69,19 +405,28 @@ def serve(node_id: str, bind: str, master_addr: str) -> None:
                 stub = pbg.DistSyncStub(ch)
                 ack = stub.RegisterNode(pb.NodeInfo(node_id=node_id, address=bind))
                 if ack.success:
-                    break
+                    return
                 last_error = RuntimeError(f"Failed to register node: {ack.message}")
         except Exception as e:
             last_error = e
         time.sleep(1.0)
-    if time.time() >= register_deadline and last_error is not None:
+    if last_error is not None:
         raise last_error
 
-    # Serve node service
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+
+async def serve(node_id: str, bind: str, master_addr: str) -> None:
+    logging.basicConfig(level=logging.INFO, format=f"[node {node_id}] %(asctime)s %(levelname)s %(message)s")
+
+    storage_dir = ROOT / "node" / "storage" / node_id
+    storage_dir.mkdir(parents=True, exist_ok=True)
+
+    await asyncio.to_thread(register_with_master, master_addr, node_id, bind)
+
+    # Serve node service; past the RPC cap new calls fail with RESOURCE_EXHAUSTED instead of queueing
+    server = grpc.aio.server(options=SERVER_OPTIONS, maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS)
     pbg.add_NodeServiceServicer_to_server(NodeServicer(storage_dir=storage_dir), server)
     server.add_insecure_port(bind)
-    server.start()
+    await server.start()
     logging.info("Node listening on %s (master=%s)", bind, master_addr)
 
     # Heartbeat thread
@@ -90,11 +435,10 @@ def serve(node_id: str, bind: str, master_addr: str) -> None:
     hb_thread.start()
 
     try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
+        await server.wait_for_termination()
+    finally:
         stop_event.set()
-        server.stop(0)
+        await server.stop(0)
 
 
 def main() -> None:
@@ -103,7 +447,10 @@ def main() -> None:
     parser.add_argument("--bind", default="127.0.0.1:50051")
     parser.add_argument("--master", default="127.0.0.1:50050")
     args = parser.parse_args()
-    serve(args.node_id, args.bind, args.master)
+    try:
+        asyncio.run(serve(args.node_id, args.bind, args.master))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
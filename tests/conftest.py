@@ -0,0 +1,24 @@
+import importlib.util
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# The servers import generated stubs; build them into a temp dir when `run_demo.sh gen` hasn't been run
+if importlib.util.find_spec("distsync_pb2") is None:
+    from grpc_tools import protoc
+
+    _stub_dir = tempfile.mkdtemp(prefix="distsync-stubs-")
+    if protoc.main([
+        "grpc_tools.protoc",
+        f"-I{ROOT / 'protos'}",
+        f"--python_out={_stub_dir}",
+        f"--grpc_python_out={_stub_dir}",
+        str(ROOT / "protos" / "distsync.proto"),
+    ]) != 0:
+        raise RuntimeError("failed to generate gRPC stubs")
+    sys.path.insert(0, _stub_dir)
@@ -1,4 +1,4 @@
-from master.hash_ring import ConsistentHashRing
+from master.hash_ring import ConsistentHashRing, chunk_hash, hash_key
 
 
 def test_hash_ring_basic_distribution():
@@ -16,3 +16,66 @@ def test_hash_ring_basic_distribution():
         for nid in p:
             assert nid in set(["a", "b", "c"])  # noqa: PLR2004
 
+
+def test_hash_ring_remove_node():
+    ring = ConsistentHashRing(replication_factor=16)
+    for nid in ("a", "b", "c"):
+        ring.add_node(nid)
+    ring.remove_node("b")
+
+    assert sorted(ring.nodes()) == ["a", "c"]
+    for i in range(100):
+        p = ring.get_nodes_for_key(f"file-{i}", count=2)
+        assert sorted(p) == ["a", "c"]
+
+    # Re-adding restores the original placement
+    fresh = ConsistentHashRing(replication_factor=16)
+    for nid in ("a", "b", "c"):
+        fresh.add_node(nid)
+    ring.add_node("b")
+    for i in range(100):
+        key = f"file-{i}"
+        assert ring.get_nodes_for_key(key, count=2) == fresh.get_nodes_for_key(key, count=2)
+
+
+def test_hash_ring_fast_paths_match_full_walk():
+    ring = ConsistentHashRing(replication_factor=16)
+    for nid in ("a", "b", "c", "d", "e"):
+        ring.add_node(nid)
+
+    def walk(key, count):
+        # Reference: clockwise walk collecting distinct owners
+        positions = sorted((ConsistentHashRing._hash_key(f"{nid}:{i}"), nid) for nid in ring.nodes() for i in range(16))
+        h = ConsistentHashRing._hash_key(key)
+        start = next((i for i, (p, _) in enumerate(positions) if p > h), 0)
+        selected = []
+        i = start
+        while len(selected) < min(count, len(ring.nodes())):
+            nid = positions[i % len(positions)][1]
+            if nid not in selected:
+                selected.append(nid)
+            i += 1
+        return selected
+
+    for count in (1, 2, 3, 4, 6):
+        for i in range(50):
+            key = f"file-{i}"
+            assert ring.get_nodes_for_key(key, count=count) == walk(key, count)
+
+    single = ConsistentHashRing(replication_factor=4)
+    single.add_node("only")
+    assert single.get_nodes_for_key("x", count=3) == ["only"]
+
+
+def test_hash_ring_chunk_hash_placement():
+    ring = ConsistentHashRing(replication_factor=16)
+    for nid in ("a", "b", "c"):
+        ring.add_node(nid)
+
+    assert ring.get_nodes_for_hash(hash_key("file-1"), count=2) == ring.get_nodes_for_key("file-1", count=2)
+
+    fh = hash_key("big.bin")
+    hashes = [chunk_hash(fh, cid) for cid in range(300)]
+    assert all(0 <= h < 2**64 for h in hashes)
+    primaries = {ring.get_nodes_for_hash(h, count=1)[0] for h in hashes}
+    assert primaries == {"a", "b", "c"}
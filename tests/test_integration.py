@@ -1,12 +1,173 @@
+import asyncio
 import os
-import subprocess
-import sys
-import time
 from pathlib import Path
 
+import grpc
+import pytest
+
+import distsync_pb2 as pb
+import distsync_pb2_grpc as pbg
+from client import client
+from master import master_server
+from master.hash_ring import chunk_hash, hash_key
+from node import node_server
+
 ROOT = Path(__file__).resolve().parents[1]
 
 
 def test_proto_exists():
     assert (ROOT / "protos" / "distsync.proto").exists()
 
+
+class Cluster:
+    """Coordinator plus storage nodes on ephemeral localhost ports, all on the running loop."""
+
+    def __init__(self, tmp_path: Path, nodes: int = 3, replication: int = 2) -> None:
+        self._tmp_path = tmp_path
+        self._node_count = nodes
+        self.coordinator = master_server.Coordinator(replication=replication, metadata_path=tmp_path / "metadata.json")
+        self.servicers = {}
+        self.node_servers = {}
+        self._servers = []
+        self._heartbeat = None
+
+    async def __aenter__(self) -> "Cluster":
+        master = grpc.aio.server(options=master_server.SERVER_OPTIONS)
+        pbg.add_DistSyncServicer_to_server(self.coordinator, master)
+        port = master.add_insecure_port("127.0.0.1:0")
+        await master.start()
+        self._servers.append(master)
+        self._channel = grpc.aio.insecure_channel(f"127.0.0.1:{port}", options=master_server.CHANNEL_OPTIONS)
+        self.stub = pbg.DistSyncStub(self._channel)
+
+        for i in range(self._node_count):
+            node_id = f"node-{i}"
+            servicer = node_server.NodeServicer(self._tmp_path / node_id)
+            server = grpc.aio.server(
+                options=node_server.SERVER_OPTIONS, maximum_concurrent_rpcs=node_server.MAX_CONCURRENT_RPCS
+            )
+            pbg.add_NodeServiceServicer_to_server(servicer, server)
+            node_port = server.add_insecure_port("127.0.0.1:0")
+            await server.start()
+            self._servers.append(server)
+            address = f"127.0.0.1:{node_port}"
+            self.servicers[address] = servicer
+            self.node_servers[address] = server
+            ack = await self.stub.RegisterNode(pb.NodeInfo(node_id=node_id, address=address))
+            assert ack.success
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._heartbeat.cancel()
+        await self._channel.close()
+        for server in self._servers:
+            await server.stop(0)
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            for i in range(self._node_count):
+                await self.stub.Heartbeat(pb.NodeHeartbeat(node_id=f"node-{i}"))
+            await asyncio.sleep(1.0)
+
+    async def upload(self, filename: str, chunks):
+        async def gen():
+            for cid, data in enumerate(chunks):
+                yield pb.FileChunk(filename=filename, data=data, chunk_id=cid, total_chunks=len(chunks))
+
+        return await self.stub.UploadFile(gen())
+
+    async def download(self, filename: str):
+        chunks = {}
+        async for loc in self.stub.GetChunkLocations(pb.FileRequest(filename=filename)):
+            request = pb.ChunkRequest(filename=filename, chunk_id=loc.chunk_id, generation=loc.generation)
+            # Try replicas in order, like the client
+            for address in loc.node_addresses:
+                async with grpc.aio.insecure_channel(address, options=master_server.CHANNEL_OPTIONS) as ch:
+                    try:
+                        resp = await pbg.NodeServiceStub(ch).GetChunk(request, timeout=5)
+                    except grpc.aio.AioRpcError:
+                        continue
+                chunks[loc.chunk_id] = resp.data
+                break
+            else:
+                raise RuntimeError(f"chunk {loc.chunk_id} unavailable")
+        return [chunks[cid] for cid in sorted(chunks)]
+
+
+def test_concurrent_uploads_do_not_wedge_chain_replication(tmp_path):
+    # Many simultaneous uploads make every node both a chain head and a downstream hop
+    # for the others; inbound streams must not starve the forwards they wait on.
+    uploads = 48
+    files = {f"file-{i}.bin": [os.urandom(32 * 1024) for _ in range(16)] for i in range(uploads)}
+
+    async def run():
+        async with Cluster(tmp_path, nodes=3, replication=3) as cluster:
+            statuses = await asyncio.wait_for(
+                asyncio.gather(*(cluster.upload(name, chunks) for name, chunks in files.items())), timeout=60
+            )
+            assert [s.message for s in statuses] == ["ok"] * uploads
+            for name in list(files)[:4]:
+                assert await cluster.download(name) == files[name]
+
+    asyncio.run(run())
+
+
+
+def test_failed_reupload_keeps_previous_copy_readable(tmp_path):
+    first = [os.urandom(4096) for _ in range(20)]
+    second = [os.urandom(4096) for _ in range(20)]
+
+    async def run():
+        async with Cluster(tmp_path, nodes=3, replication=2) as cluster:
+            assert (await cluster.upload("small.bin", first)).message == "ok"
+            # A node dies but is still within its heartbeat window, so placement keeps using it
+            dead = next(iter(cluster.node_servers))
+            await cluster.node_servers[dead].stop(0)
+            status = await cluster.upload("small.bin", second)
+            assert status.message != "ok"
+            assert await cluster.download("small.bin") == first
+
+    asyncio.run(run())
+
+def test_upload_batch_stores_small_file_in_one_message(tmp_path):
+    path = tmp_path / "small.bin"
+    path.write_bytes(os.urandom(300 * 1024 + 5))
+    batch = client.file_batch(str(path), chunk_size=64 * 1024)
+    assert len(batch.chunks) == 5
+
+    async def run():
+        async with Cluster(tmp_path, nodes=3, replication=2) as cluster:
+            status = await cluster.stub.UploadBatch(batch)
+            assert status.message == "ok"
+            assert b"".join(await cluster.download("small.bin")) == path.read_bytes()
+            # every chunk reached both replicas of its chain
+            for cid, data in enumerate(batch.chunks):
+                holders = [s for s in cluster.servicers.values() if s._read_chunk("small.bin", cid) == data]
+                assert len(holders) == 2
+
+    asyncio.run(run())
+
+
+def test_get_chunk_locations_lists_live_replicas_in_ring_order(tmp_path):
+    chunks = [os.urandom(1024) for _ in range(12)]
+
+    async def run():
+        async with Cluster(tmp_path, nodes=3, replication=2) as cluster:
+            assert (await cluster.upload("f.bin", chunks)).message == "ok"
+            locations = [loc async for loc in cluster.stub.GetChunkLocations(pb.FileRequest(filename="f.bin"))]
+            assert [loc.chunk_id for loc in locations] == list(range(len(chunks)))
+            coordinator = cluster.coordinator
+            for loc in locations:
+                key_hash = chunk_hash(hash_key("f.bin"), loc.chunk_id)
+                expected = [coordinator._node_address[n] for n in coordinator._ring.get_nodes_for_hash(key_hash, 2)]
+                assert list(loc.node_addresses) == expected
+                for address in loc.node_addresses:
+                    assert cluster.servicers[address]._read_chunk("f.bin", loc.chunk_id) == chunks[loc.chunk_id]
+
+            with pytest.raises(grpc.aio.AioRpcError) as err:
+                async for _ in cluster.stub.GetChunkLocations(pb.FileRequest(filename="missing.bin")):
+                    pass
+            assert err.value.code() == grpc.StatusCode.NOT_FOUND
+
+    asyncio.run(run())
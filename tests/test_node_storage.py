@@ -0,0 +1,191 @@
+import asyncio
+import threading
+
+import grpc
+import pytest
+
+import distsync_pb2 as pb
+from node.node_server import INDEX_ENTRY, STREAM_PIECE_SIZE, NodeServicer
+
+
+class Aborted(Exception):
+    pass
+
+
+class StubContext:
+    """Just enough of grpc.aio.ServicerContext for calling NodeServicer handlers directly."""
+
+    def __init__(self) -> None:
+        self.code = None
+
+    async def abort(self, code, details):
+        self.code = code
+        raise Aborted(details)
+
+
+def chunk(filename, chunk_id, data, generation=0):
+    return pb.FileChunk(filename=filename, data=data, chunk_id=chunk_id, total_chunks=0, generation=generation)
+
+
+async def stream(*chunks):
+    for c in chunks:
+        yield c
+
+
+async def store(servicer, filename, chunks, generation=0):
+    ack = await servicer.StoreChunkStream(
+        stream(*(chunk(filename, cid, data, generation) for cid, data in chunks.items())), StubContext()
+    )
+    assert ack.success
+    ack = await servicer.Sync(pb.FileRequest(filename=filename), StubContext())
+    assert ack.success
+
+
+async def commit(servicer, filename, generation):
+    return await servicer.Commit(pb.FileRequest(filename=filename, generation=generation), StubContext())
+
+
+async def read_stream(servicer, filename, chunk_id, context=None):
+    request = pb.ChunkRequest(filename=filename, chunk_id=chunk_id)
+    return [p.data async for p in servicer.GetChunkStream(request, context or StubContext())]
+
+
+def test_packed_layout_round_trips_offsets_and_lengths(tmp_path):
+    servicer = NodeServicer(tmp_path)
+    chunks = {3: b"c" * 300, 0: b"a" * 100, 1: b"", 5: b"e" * 7}
+
+    async def run():
+        await store(servicer, "dir/file.bin", chunks, generation=7)
+        assert (await commit(servicer, "dir/file.bin", 7)).success
+
+    asyncio.run(run())
+
+    blob = tmp_path / "dir_file.bin.7.blob"
+    idx = tmp_path / "dir_file.bin.7.idx"
+    assert sorted(p.name for p in tmp_path.iterdir()) == [blob.name, idx.name, "dir_file.bin.gen"]
+    assert blob.stat().st_size == sum(len(d) for d in chunks.values())
+    assert idx.stat().st_size == 6 * INDEX_ENTRY.size
+    raw = blob.read_bytes()
+    for cid, data in chunks.items():
+        path, offset, length = servicer._read_index("dir/file.bin", cid)
+        assert (path, length) == (blob, len(data))
+        assert raw[offset: offset + length] == data
+        assert servicer._read_chunk("dir/file.bin", cid) == data
+    # gaps in the index, ids past its end and negative ids are all missing
+    for cid in (2, 4, 6, 1000, -1):
+        assert servicer._read_chunk("dir/file.bin", cid) is None
+    assert servicer._read_chunk("other.bin", 0) is None
+
+
+def test_get_chunk_stream_splits_on_piece_boundaries(tmp_path):
+    servicer = NodeServicer(tmp_path)
+    chunks = {
+        0: bytes(range(256)) * (2 * STREAM_PIECE_SIZE // 256) + b"tail!!!",
+        1: b"x" * STREAM_PIECE_SIZE,
+        2: b"",
+    }
+
+    async def run():
+        await store(servicer, "f.bin", {0: b"filler"})  # chunk 0 of the real upload starts mid-blob
+        await store(servicer, "f.bin", chunks)
+        pieces = await read_stream(servicer, "f.bin", 0)
+        assert [len(p) for p in pieces] == [STREAM_PIECE_SIZE, STREAM_PIECE_SIZE, 7]
+        assert b"".join(pieces) == chunks[0]
+        assert await read_stream(servicer, "f.bin", 1) == [chunks[1]]
+        assert await read_stream(servicer, "f.bin", 2) == [b""]
+        ctx = StubContext()
+        with pytest.raises(Aborted):
+            await read_stream(servicer, "f.bin", 3, ctx)
+        assert ctx.code == grpc.StatusCode.NOT_FOUND
+
+    asyncio.run(run())
+
+
+def test_reupload_is_staged_until_committed(tmp_path):
+    servicer = NodeServicer(tmp_path)
+    first = {cid: bytes([cid]) * 1000 for cid in range(4)}
+    second = {cid: bytes([cid + 10]) * 500 for cid in range(2)}
+
+    async def run():
+        await store(servicer, "f.bin", first, generation=1)
+        assert (await commit(servicer, "f.bin", 1)).success
+        # An uncommitted (e.g. failed) re-upload leaves the committed copy readable
+        await store(servicer, "f.bin", {0: second[0]}, generation=2)
+        assert [servicer._read_chunk("f.bin", cid) for cid in range(4)] == list(first.values())
+        assert servicer._read_chunk("f.bin", 0, generation=2) == second[0]
+
+        await store(servicer, "f.bin", {1: second[1]}, generation=2)
+        assert (await commit(servicer, "f.bin", 2)).success
+        # a straggler from the older upload must not resurrect it, and its Sync fails
+        await servicer.StoreChunk(chunk("f.bin", 3, b"stale", generation=1), StubContext())
+        ack = await servicer.Sync(pb.FileRequest(filename="f.bin"), StubContext())
+        assert not ack.success
+        assert not (await commit(servicer, "f.bin", 1)).success
+
+    asyncio.run(run())
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["f.bin.2.blob", "f.bin.2.idx", "f.bin.gen"]
+    assert (tmp_path / "f.bin.2.blob").stat().st_size == 1000
+    # a restarted node picks up the committed generation from disk
+    restarted = NodeServicer(tmp_path)
+    assert [restarted._read_chunk("f.bin", cid) for cid in range(4)] == [second[0], second[1], None, None]
+
+
+def test_pending_chunks_are_served_and_sync_waits_only_for_its_file(tmp_path):
+    servicer = NodeServicer(tmp_path)
+    release = threading.Event()
+    write_chunk = servicer._write_chunk
+
+    def slow_write(filename, chunk_id, data, generation=0):
+        if filename == "slow.bin":
+            release.wait(timeout=10)
+        return write_chunk(filename, chunk_id, data, generation)
+
+    servicer._write_chunk = slow_write
+
+    async def run():
+        chunks = stream(chunk("slow.bin", 0, b"slow"), chunk("fast.bin", 0, b"fast"))
+        await servicer.StoreChunkStream(chunks, StubContext())
+        # Not on disk yet, but readable from the pending map
+        resp = await servicer.GetChunk(pb.ChunkRequest(filename="slow.bin", chunk_id=0), StubContext())
+        assert resp.data == b"slow"
+        pieces = await read_stream(servicer, "slow.bin", 0)
+        assert pieces == [b"slow"]
+
+        # A blocked write of one file must not hold up Sync of another
+        ack = await asyncio.wait_for(servicer.Sync(pb.FileRequest(filename="fast.bin"), StubContext()), timeout=5)
+        assert ack.success
+        slow_sync = asyncio.create_task(servicer.Sync(pb.FileRequest(filename="slow.bin"), StubContext()))
+        await asyncio.sleep(0.05)
+        assert not slow_sync.done()
+        release.set()
+        ack = await asyncio.wait_for(slow_sync, timeout=5)
+        assert ack.success
+        assert servicer._pending == {}
+
+    asyncio.run(run())
+
+
+def test_sync_reports_failed_writes(tmp_path):
+    servicer = NodeServicer(tmp_path)
+
+    def failing_write(filename, chunk_id, data, generation=0):
+        raise OSError("disk full")
+
+    servicer._write_chunk = failing_write
+
+    async def run():
+        ack = await servicer.StoreChunk(chunk("a.bin", 0, b"data"), StubContext())
+        assert ack.success  # acked once queued
+        ack = await servicer.Sync(pb.FileRequest(filename="a.bin"), StubContext())
+        assert not ack.success
+        assert "1 chunk writes failed" in ack.message
+        ctx = StubContext()
+        with pytest.raises(Aborted):
+            await servicer.GetChunk(pb.ChunkRequest(filename="a.bin", chunk_id=0), ctx)
+        assert ctx.code == grpc.StatusCode.NOT_FOUND
+        # The failure is reported once; a later upload starts clean
+        ack = await servicer.Sync(pb.FileRequest(filename="a.bin"), StubContext())
+        assert ack.success
+
+    asyncio.run(run())